@@ -3,8 +3,22 @@
 # =========================================================
 import streamlit as st
 import pandas as pd
+import numpy as np
 import plotly.express as px
 import io
+import hashlib
+import zipfile
+
+try:
+    import python_calamine  # noqa: F401
+    EXCEL_ENGINE = "calamine"
+except ImportError:
+    # openpyxl reader already opens workbooks in read-only mode
+    EXCEL_ENGINE = "openpyxl"
+
+# copy-on-write is always on from pandas 3, where the option is deprecated
+if int(pd.__version__.split(".")[0]) < 3:
+    pd.set_option("mode.copy_on_write", True)
 
 # =========================================================
 # PAGE CONFIG
@@ -28,121 +42,119 @@ if uploaded_file is None:
     st.stop()
 
 # =========================================================
-# LOAD DATA (OLD LOGIC)
+# ABC CALCULATION (CACHED)
 # =========================================================
-sheets = pd.read_excel(uploaded_file, sheet_name=None)
-sheet_names = list(sheets.keys())
+class CostpoolsError(ValueError):
+    pass
 
-cost_sheet = next((s for s in sheet_names if "cost" in s.lower()), sheet_names[0])
-event_sheet = next((s for s in sheet_names if "event" in s.lower()), sheet_names[1])
 
-cost_df = sheets[cost_sheet].copy()
-event_df = sheets[event_sheet].copy()
+@st.cache_data
+def compute_abc(
+    file_bytes: bytes
+) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    # ---------------- LOAD DATA (OLD LOGIC) ----------------
+    sheets = pd.read_excel(
+        io.BytesIO(file_bytes),
+        sheet_name=None,
+        engine=EXCEL_ENGINE
+    )
+    sheet_names = list(sheets.keys())
 
-# =========================================================
-# VALIDATION
-# =========================================================
-required_cols = {"Activity", "Type", "Total_Cost", "Driver"}
-if not required_cols.issubset(cost_df.columns):
-    st.error("Costpools sheet ต้องมี Activity, Type, Total_Cost, Driver")
-    st.stop()
+    cost_sheet = next((s for s in sheet_names if "cost" in s.lower()), sheet_names[0])
+    event_sheet = next((s for s in sheet_names if "event" in s.lower()), sheet_names[1])
 
-# =========================================================
-# DRIVER UNITS (TOTAL ROW)
-# =========================================================
-total_row = event_df.iloc[-1]
-numeric_cols = event_df.select_dtypes(include="number").columns
-
-driver_units = {
-    str(k).strip(): float(v)
-    for k, v in total_row[numeric_cols].to_dict().items()
-    if pd.notna(v)
-}
-
-def get_driver_units(driver):
-    if pd.isna(driver):
-        return 0
-    return driver_units.get(str(driver).strip(), 0)
-
-cost_df["Driver_Units"] = cost_df["Driver"].apply(get_driver_units)
-cost_df["RatePerDriverUnit"] = cost_df.apply(
-    lambda r: r["Total_Cost"] / r["Driver_Units"] if r["Driver_Units"] != 0 else 0,
-    axis=1
-)
+    cost_df = sheets[cost_sheet]
+    event_df = sheets[event_sheet]
 
-# =========================================================
-# REMOVE TOTAL ROW FROM EVENTS
-# =========================================================
-events_clean = event_df.iloc[:-1].copy()
+    # ---------------- VALIDATION ----------------
+    required_cols = {"Activity", "Type", "Total_Cost", "Driver"}
+    if not required_cols.issubset(cost_df.columns):
+        raise CostpoolsError("Costpools sheet ต้องมี Activity, Type, Total_Cost, Driver")
 
-# =========================================================
-# COST ALLOCATION
-# =========================================================
-costs_data = []
+    # ---------------- DRIVER UNITS (TOTAL ROW) ----------------
+    numeric_cols = event_df.select_dtypes(include="number").columns
+    total_row = event_df[numeric_cols].iloc[-1].rename(lambda c: str(c).strip())
+    total_row = total_row.dropna()
+    total_row = total_row[~total_row.index.duplicated(keep="last")]
 
-for _, flight_row in events_clean.iterrows():
-    flight_name = flight_row.iloc[0]
-    row_cost = {"Flight": str(flight_name)}
+    drivers_clean = cost_df["Driver"].astype(str).str.strip()
+    cost_df["Driver_Units"] = total_row.reindex(drivers_clean).to_numpy(
+        dtype=np.float64,
+        na_value=0.0
+    )
 
-    for _, act in cost_df.iterrows():
-        row_cost[act["Activity"]] = (
-            flight_row.get(act["Driver"], 0) * act["RatePerDriverUnit"]
-        )
+    tc = cost_df["Total_Cost"].to_numpy(dtype=np.float64)
+    du = cost_df["Driver_Units"].to_numpy(dtype=np.float64)
+    rate = np.zeros_like(tc)
+    np.divide(tc, du, out=rate, where=du != 0)
+    cost_df["RatePerDriverUnit"] = rate
 
-    costs_data.append(row_cost)
+    # ---------------- REMOVE TOTAL ROW FROM EVENTS ----------------
+    events_clean = event_df.iloc[:-1]
+    flights = events_clean.iloc[:, 0].astype(str).to_numpy()
 
-costs_df = pd.DataFrame(costs_data)
-costs_df["Total_Cost_Per_Flight"] = costs_df.drop(
-    columns=["Flight"]
-).sum(axis=1)
+    # ---------------- COST ALLOCATION ----------------
+    drivers = cost_df["Driver"].tolist()
 
-# =========================================================
-# SUMMARY BY TYPE 
-# =========================================================
-summary = pd.DataFrame()
-summary["Flight"] = costs_df["Flight"]
+    D = events_clean.reindex(columns=drivers).fillna(0).to_numpy(dtype=np.float64)
+    rates = cost_df["RatePerDriverUnit"].to_numpy()
+    alloc = D * rates[None, :]
 
-for t in cost_df["Type"].unique():
-    acts = cost_df.loc[cost_df["Type"] == t, "Activity"]
-    summary[f"{t}_Cost"] = costs_df[acts].sum(axis=1)
+    costs_df = pd.DataFrame(alloc, columns=cost_df["Activity"].values)
+    costs_df.insert(0, "Flight", flights)
+    costs_df["Total_Cost_Per_Flight"] = alloc.sum(axis=1)
 
-summary["Total_Cost_Per_Flight"] = costs_df["Total_Cost_Per_Flight"]
+    # ---------------- SUMMARY BY TYPE ----------------
+    codes, types = pd.factorize(cost_df["Type"], use_na_sentinel=False)
+    onehot = np.zeros((len(codes), len(types)))
+    onehot[np.arange(len(codes)), codes] = 1.0
 
-# =========================================================
-# PREP DATA FOR VISUAL
-# =========================================================
-viz_df = events_clean.copy()
-viz_df["Flight"] = viz_df.iloc[:, 0].astype(str)
+    type_sums = pd.DataFrame(
+        alloc @ onehot,
+        columns=[f"{t}_Cost" for t in types]
+    )
 
-# =========================================================
-# CREATE TIME PERIOD FROM DEPARTURE TIME
-# =========================================================
-viz_df["Departure Time"] = pd.to_datetime(
-    viz_df["Departure Time"],
-    errors="coerce"
-)
+    summary = pd.concat(
+        [costs_df[["Flight"]], type_sums, costs_df[["Total_Cost_Per_Flight"]]],
+        axis=1
+    )
 
-def get_time_period(t):
-    if pd.isna(t):
-        return "Unknown"
-    hour = t.hour
-    if 5 <= hour < 12:
-        return "Morning"
-    elif 12 <= hour < 17:
-        return "Afternoon"
-    elif 17 <= hour < 21:
-        return "Evening"
-    else:
-        return "Night"
-
-viz_df["Time Period"] = viz_df["Departure Time"].apply(get_time_period)
-
-
-viz_df = viz_df.merge(
-    summary[["Flight", "Total_Cost_Per_Flight"]],
-    on="Flight",
-    how="left"
-)
+    # ---------------- PREP DATA FOR VISUAL ----------------
+    viz_df = events_clean
+    viz_df["Flight"] = flights
+
+    # ---------------- CREATE TIME PERIOD FROM DEPARTURE TIME ----------------
+    viz_df["Departure Time"] = pd.to_datetime(
+        viz_df["Departure Time"],
+        errors="coerce"
+    )
+
+    h = viz_df["Departure Time"].dt.hour.to_numpy()
+
+    periods = np.select(
+        [h < 5, h < 12, h < 17, h < 21],
+        ["Night", "Morning", "Afternoon", "Evening"],
+        default="Night"
+    )
+
+    viz_df["Time Period"] = np.where(pd.isna(h), "Unknown", periods)
+
+    for c in ("Continent", "Destination Code", "Time Period"):
+        viz_df[c] = viz_df[c].astype("category")
+
+    viz_df["Total_Cost_Per_Flight"] = summary["Total_Cost_Per_Flight"].to_numpy()
+
+    return cost_df, event_df, costs_df, summary, viz_df
+
+
+file_bytes = uploaded_file.getvalue()
+file_key = hashlib.sha256(file_bytes).hexdigest()
+
+try:
+    cost_df, event_df, costs_df, summary, viz_df = compute_abc(file_bytes)
+except CostpoolsError as e:
+    st.error(str(e))
+    st.stop()
 
 # =========================================================
 # SIDEBAR FILTERS
@@ -165,25 +177,19 @@ selected_period = st.sidebar.selectbox(
 )
 
 
-filtered_viz = viz_df.copy()
+mask = np.ones(len(viz_df), dtype=bool)
+
 if selected_continent != "All":
-    filtered_viz = filtered_viz[
-        filtered_viz["Continent"] == selected_continent
-    ]
+    mask &= viz_df["Continent"].to_numpy() == selected_continent
+
 if selected_dest != "All":
-    filtered_viz = filtered_viz[
-        filtered_viz["Destination Code"] == selected_dest
-    ]
+    mask &= viz_df["Destination Code"].to_numpy() == selected_dest
 
 if selected_period != "All":
-    filtered_viz = filtered_viz[
-        filtered_viz["Time Period"] == selected_period
-    ]
+    mask &= viz_df["Time Period"].to_numpy() == selected_period
 
-
-filtered_summary = summary[
-    summary["Flight"].isin(filtered_viz["Flight"])
-]
+filtered_viz = viz_df.loc[mask]
+filtered_summary = summary.loc[mask]
 
 # =========================================================
 # TABLE SECTION 
@@ -191,14 +197,33 @@ filtered_summary = summary[
 st.markdown("---")
 st.header("ABC Calculation Tables")
 
+def float_format(df: pd.DataFrame, fmt: str) -> dict:
+    return {
+        c: st.column_config.NumberColumn(format=fmt)
+        for c in df.columns
+        if pd.api.types.is_float_dtype(df[c])
+    }
+
 with st.expander("Costpools & Driver Rates"):
-    st.dataframe(cost_df.round(3), use_container_width=True)
+    st.dataframe(
+        cost_df,
+        column_config=float_format(cost_df, "%.3f"),
+        use_container_width=True
+    )
 
 with st.expander("Cost Allocation (Flight × Activity)"):
-    st.dataframe(costs_df.round(2), use_container_width=True)
+    st.dataframe(
+        costs_df,
+        column_config=float_format(costs_df, "%.2f"),
+        use_container_width=True
+    )
 
 with st.expander("Cost Summary by Type"):
-    st.dataframe(summary.round(2), use_container_width=True)
+    st.dataframe(
+        summary,
+        column_config=float_format(summary, "%.2f"),
+        use_container_width=True
+    )
 
 # =========================================================
 # ================= NEW VISUAL SECTION ====================
@@ -226,10 +251,7 @@ k4.metric(
 # ---------------- MAIN BAR ----------------
 st.subheader("Top 5 Flights by Total Cost")
 
-top5 = filtered_summary.sort_values(
-    "Total_Cost_Per_Flight",
-    ascending=False
-).head(5)
+top5 = filtered_summary.nlargest(5, "Total_Cost_Per_Flight")
 
 melted = top5.melt(
     id_vars=["Flight"],
@@ -255,7 +277,8 @@ st.plotly_chart(
 st.markdown("### Cost by Time Period")
 
 time_df = filtered_viz.groupby(
-    "Time Period"
+    "Time Period",
+    observed=True
 )["Total_Cost_Per_Flight"].sum().reset_index()
 
 st.plotly_chart(
@@ -271,13 +294,11 @@ st.plotly_chart(
 st.markdown("### Cost by Destination Code")
 
 dest_df = filtered_viz.groupby(
-    "Destination Code"
+    "Destination Code",
+    observed=True
 )["Total_Cost_Per_Flight"].sum().reset_index()
 
-dest_df = dest_df.sort_values(
-    "Total_Cost_Per_Flight",
-    ascending=False
-).head(10)
+dest_df = dest_df.nlargest(10, "Total_Cost_Per_Flight")
 
 st.plotly_chart(
     px.bar(
@@ -308,7 +329,8 @@ with c1:
 with c2:
     st.subheader("Cost by Continent")
     cont_df = filtered_viz.groupby(
-        "Continent"
+        "Continent",
+        observed=True
     )["Total_Cost_Per_Flight"].sum().reset_index()
 
     st.plotly_chart(
@@ -344,50 +366,79 @@ with c3:
 # =========================================================
 # EXPORT
 # =========================================================
-st.markdown("---")
-output = io.BytesIO()
-
-with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
-    cost_df.to_excel(writer, index=False, sheet_name="Costpools")
-    event_df.to_excel(writer, index=False, sheet_name="Events")
-    costs_df.to_excel(writer, index=False, sheet_name="Cost_Allocation")
-    summary.to_excel(writer, index=False, sheet_name="Summary")
-
-st.download_button(
-    "Download Final ABC Report",
-    data=output.getvalue(),
-    file_name="ABC_Final_Report.xlsx"
-)
+@st.cache_data
+def build_excel_report(
+    file_key: str,
+    _cost_df: pd.DataFrame,
+    _event_df: pd.DataFrame,
+    _costs_df: pd.DataFrame,
+    _summary: pd.DataFrame
+) -> bytes:
+    output = io.BytesIO()
+
+    # constant_memory is not usable here: to_excel writes column by column
+    with pd.ExcelWriter(
+        output,
+        engine="xlsxwriter",
+        engine_kwargs={
+            "options": {"strings_to_numbers": False, "strings_to_urls": False}
+        }
+    ) as writer:
+        _cost_df.to_excel(writer, index=False, sheet_name="Costpools")
+        _event_df.to_excel(writer, index=False, sheet_name="Events")
+        _costs_df.to_excel(writer, index=False, sheet_name="Cost_Allocation")
+        _summary.to_excel(writer, index=False, sheet_name="Summary")
+
+    return output.getvalue()
+
+
+@st.cache_data
+def build_csv_zip(
+    file_key: str,
+    _cost_df: pd.DataFrame,
+    _event_df: pd.DataFrame,
+    _costs_df: pd.DataFrame,
+    _summary: pd.DataFrame
+) -> bytes:
+    csv_buffer = io.BytesIO()
+
+    with zipfile.ZipFile(
+        csv_buffer,
+        "w",
+        zipfile.ZIP_DEFLATED,
+        compresslevel=1
+    ) as zipf:
+        for name, df in [
+            ("Costpools.csv", _cost_df),
+            ("Events.csv", _event_df),
+            ("Cost_Allocation.csv", _costs_df),
+            ("Summary.csv", _summary)
+        ]:
+            with zipf.open(name, "w", force_zip64=True) as fp, io.TextIOWrapper(
+                fp, encoding="utf-8", newline=""
+            ) as tw:
+                df.to_csv(tw, index=False)
+
+    return csv_buffer.getvalue()
 
-# =========================================================
-# EXPORT CSV (ZIP)
-# =========================================================
-import zipfile
 
-csv_buffer = io.BytesIO()
+st.markdown("---")
 
-with zipfile.ZipFile(csv_buffer, "w", zipfile.ZIP_DEFLATED) as zipf:
-    zipf.writestr(
-        "Costpools.csv",
-        cost_df.to_csv(index=False)
-    )
-    zipf.writestr(
-        "Events.csv",
-        event_df.to_csv(index=False)
-    )
-    zipf.writestr(
-        "Cost_Allocation.csv",
-        costs_df.to_csv(index=False)
-    )
-    zipf.writestr(
-        "Summary.csv",
-        summary.to_csv(index=False)
-    )
+# frames are derived from the upload, so the builders are keyed on it
+if st.button("Prepare downloads"):
+    st.session_state["downloads_ready"] = file_key
 
-st.download_button(
-    "Download ABC Data (CSV)",
-    data=csv_buffer.getvalue(),
-    file_name="ABC_Data_CSV.zip",
-    mime="application/zip"
-)
+if st.session_state.get("downloads_ready") == file_key:
+    st.download_button(
+        "Download Final ABC Report",
+        data=build_excel_report(file_key, cost_df, event_df, costs_df, summary),
+        file_name="ABC_Final_Report.xlsx"
+    )
 
+    # ---------------- EXPORT CSV (ZIP) ----------------
+    st.download_button(
+        "Download ABC Data (CSV)",
+        data=build_csv_zip(file_key, cost_df, event_df, costs_df, summary),
+        file_name="ABC_Data_CSV.zip",
+        mime="application/zip"
+    )